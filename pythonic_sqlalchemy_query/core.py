@@ -9,18 +9,22 @@
 #
 # Standard library
 # ----------------
-# None.
+from collections import namedtuple
+from functools import lru_cache, wraps
+import sys
+from types import FunctionType, MethodType
+from weakref import WeakKeyDictionary
 #
 # Third-party imports
 # -------------------
-from sqlalchemy.orm import Query, scoped_session
-from sqlalchemy.orm.attributes import InstrumentedAttribute
+from sqlalchemy.orm import Query, scoped_session, raiseload
+from sqlalchemy.ext import baked
 from sqlalchemy.orm.properties import ColumnProperty, RelationshipProperty
 from sqlalchemy.ext.declarative import DeclarativeMeta
-from sqlalchemy.orm.base import _generative
-from sqlalchemy.sql.elements import ClauseElement
+from sqlalchemy.sql.elements import ClauseElement, BinaryExpression, BindParameter
+from sqlalchemy.sql.expression import bindparam
+from sqlalchemy.schema import Column
 from sqlalchemy.orm.session import Session
-from sqlalchemy.orm.util import class_mapper
 from sqlalchemy.orm.mapper import Mapper
 from sqlalchemy.inspection import inspect
 
@@ -36,6 +40,7 @@ from sqlalchemy.inspection import inspect
 # - Constructor: ``session(User)`` (with help from QueryMakerSession_) creates a query on a User table.
 # - Indexing: ``session(User)['jack']`` performs filtering.
 # - Attributes: ``session(User)['jack'].addresses`` joins to the Addresses table.
+# - Chaining: ``chain_attributes(session(User), 'addresses', 'email_address')`` looks up several attributes at once.
 # - Iteration: ``for x in session(User)['jack'].addresses`` iterates over the results of the query.
 # - Query access: ``User['jack'].addresses.q`` returns a Query-like object. Any Query_ method can be invoked on it.
 #
@@ -62,87 +67,234 @@ from sqlalchemy.inspection import inspect
 # Rationale:
 #
 # - Per the docs on delete_ and update_, these come with a long list of caveats. Making dangerous functions easy to invoke is poor design.
-# - For implementation, QueryMaker_ cannot invoke `select_from <http://docs.sqlalchemy.org/en/latest/orm/query.html#sqlalchemy.orm.query.Query.select_from>`_. Doing so raises ``sqlalchemy.exc.InvalidRequestError: Can't call Query.update() or Query.delete() when join(), outerjoin(), select_from(), or from_self() has been called``. So, select_from_ must be deferred -- but to when? ``User['jack'].addresses`` requires a select_from_, while ``User['jack']`` needs just ``add_entity``. We can't know which to invoke until the entire expression is complete.
+# - For implementation, QueryMaker_ cannot invoke `select_from <http://docs.sqlalchemy.org/en/latest/orm/query.html#sqlalchemy.orm.query.Query.select_from>`_. Doing so raises ``sqlalchemy.exc.InvalidRequestError: Can't call Query.update() or Query.delete() when join(), outerjoin(), select_from(), or from_self() has been called``. So, select_from_ must be deferred -- but to when? ``User['jack'].addresses`` requires a select_from_, while ``User['jack']`` needs just ``add_entity``. We can't know which to invoke until the entire expression is complete. Since QueryMaker_ now builds the query in ``to_query``, a query without joins no longer uses select_from_; however, the first point still applies.
+#
+# Likewise, a column or relationship can't be reached as an attribute if QueryMaker_ defines an attribute with the same name: ``q``, ``to_query``, or any name beginning with an underscore. Use `chain_attributes`_ instead; for example, ``chain_attributes(session(User), 'q')``. To keep this list short, operations such as `compile_query`_ are functions rather than methods.
 class QueryMaker(object):
+    # Each step in a query creates a new QueryMaker_, so keep them small: store these fields in slots instead of a per-instance ``__dict__``.
+    __slots__ = ('_strict_loading', '_ops', '_base', '_select', '_select_method', '_root_class', '_joinpoint', '_cached_query', '_session')
+
+    # Identify instances of this class without requiring an ``isinstance`` check.
+    _is_query_maker = True
+
+    # Cache the SQL compiled for each shape of query; see ``__iter__``. This is a least-recently-used cache, so that many distinct shapes of queries don't cause unbounded growth.
+    _bakery = baked.bakery(size=1024)
+
     def __init__(self,
         # An optional `Declarative class <http://docs.sqlalchemy.org/en/latest/orm/tutorial.html#declare-a-mapping>`_ to query.
         declarative_class=None,
         # Optionally, begin with an existing query_.
-        query=None):
+        query=None,
+        # Optionally, the `Session <http://docs.sqlalchemy.org/en/latest/orm/session_api.html?highlight=session#sqlalchemy.orm.session.Session>`_ to run this query in. This is ignored if a query is provided.
+        session=None,
+        # If True, apply `raiseload('*') <http://docs.sqlalchemy.org/en/latest/orm/loading_relationships.html#sqlalchemy.orm.raiseload>`_ to the resulting query, so that accessing a relationship which wasn't already loaded raises an exception instead of silently emitting another SELECT.
+        strict_loading=False):
 
         if declarative_class:
             assert _is_mapped_class(declarative_class)
 
+        self._strict_loading = strict_loading
+
+        # Rather than building a Query_ on each join or filter, record these operations as a tuple of ``(operation, argument)`` pairs, applied to the starting query (``self._base``, which is ``None`` until needed if this QueryMaker_ started from a class) only when the query is needed. See the ``_query`` property.
+        self._ops = ()
+
         # If a query is provided, try to infer the declarative_class.
         if query is not None:
             assert isinstance(query, Query)
-            self._query = query
-            try:
-                self._select = self._get_joinpoint_zero_class()
-            except:
+            self._base = query
+            self._session = query.session
+            self._select = self._get_joinpoint_zero_class()
+            if self._select is None:
                 # We can't infer it. Use what's provided instead, and add this to the query.
                 assert declarative_class
                 self._select = declarative_class
-                self._query = self._query.select_from(declarative_class)
-            else:
+                self._base = self._base.select_from(declarative_class)
+            elif declarative_class:
                 # If a declarative_class was provided, make sure it's consistent with the inferred class.
-                if declarative_class:
-                    assert declarative_class is self._select
+                assert declarative_class is self._select
+            # The contents of the provided query are unknown, so this query can't be baked.
+            self._root_class = None
         else:
             # The declarative class must be provided if the query wasn't.
             assert declarative_class
-            # Since a query was not provied, create an empty `query <http://docs.sqlalchemy.org/en/latest/orm/query.html>`_; ``to_query`` will fill in the missing information.
-            self._query = Query([]).select_from(declarative_class)
+            # Since a query was not provied, the starting query is an empty `query <http://docs.sqlalchemy.org/en/latest/orm/query.html>`_ which selects from ``declarative_class``; ``to_query`` will fill in the missing information. Don't create it yet: queries without joins never need it (see ``to_query``), so ``_query`` creates it only when it's used.
+            self._base = None
+            self._session = session
             # Keep track of the last selectable construct, to generate the select in ``to_query``.
             self._select = declarative_class
+            # Since this query starts from ``declarative_class`` alone, ``__iter__`` can rebuild it as a `baked query <http://docs.sqlalchemy.org/en/latest/orm/extensions/baked.html>`_.
+            self._root_class = declarative_class
+
+        # Keep track of the class at the join point, which determines the meaning of attributes and indexes.
+        self._joinpoint = self._select
+
+        # The Query_ method which adds ``self._select`` to a query. The select is a class unless an attribute lookup selected a column; see ``chain``.
+        self._select_method = Query.add_entity
+
+        # Cache the result of ``to_query`` as a ``(session, query)`` pair; see ``to_query``.
+        self._cached_query = None
 
-    # Copied verbatim from ``sqlalchemy.orm.query.Query._clone``. This adds the support needed for the _`generative` interface. (Mostly) quoting from query_, "QueryMaker_ features a generative interface whereby successive calls return a new QueryMaker_ object, a copy of the former with additional criteria and options associated with it."
+    # Based on ``sqlalchemy.orm.query.Query._clone``, but copying slots instead of ``__dict__``. This adds the support needed for the _`generative` interface. (Mostly) quoting from query_, "QueryMaker_ features a generative interface whereby successive calls return a new QueryMaker_ object, a copy of the former with additional criteria and options associated with it."
+    #
+    # This runs on every step of a query, so copy each slot directly rather than looping over ``__slots__`` with ``getattr``/``setattr``. Keep this in sync with ``__slots__``.
     def _clone(self):
         cls = self.__class__
         q = cls.__new__(cls)
-        q.__dict__ = self.__dict__.copy()
+        q._strict_loading = self._strict_loading
+        q._ops = self._ops
+        q._base = self._base
+        q._session = self._session
+        q._select = self._select
+        q._select_method = self._select_method
+        q._root_class = self._root_class
+        q._joinpoint = self._joinpoint
+        # The clone will be changed, so it can't use this query.
+        q._cached_query = None
         return q
 
+    # Build the query by applying the recorded operations to the starting query. Pass consecutive filters to a single call of ``filter``, which combines them using ``and_``; this avoids creating an intermediate Query_ for each filter.
+    @property
+    def _query(self):
+        return self._build_query(self._session)
+
+    # Apply the recorded operations to the starting query, which (if this QueryMaker_ started from a class) is created using ``session``.
+    def _build_query(self, session):
+        query = self._base
+        if query is None:
+            # Let the session create the query, so that it uses the session's ``query_cls`` (for example, Flask-SQLAlchemy's ``BaseQuery``, which provides ``paginate``). Without a session, share one starting query per class.
+            if session:
+                query = session.query().select_from(self._root_class)
+            else:
+                query = _starter_query(self._root_class)
+        criteria = []
+        for op, arg in self._ops:
+            if op == 'filter':
+                criteria.append(arg)
+            else:
+                if criteria:
+                    query = query.filter(*criteria)
+                    criteria = []
+                query = query.join(arg)
+        if criteria:
+            query = query.filter(*criteria)
+        return query
+
+    # Replacing the query discards the recorded operations. Since the contents of the new query are unknown, it can't be baked.
+    @_query.setter
+    def _query(self, query):
+        self._base = query
+        self._session = query.session
+        self._ops = ()
+        self._root_class = None
+        self._cached_query = None
+
+    # Return a copy of this QueryMaker_ which uses the given raw query (one which doesn't include what to select), such as a query produced by calling a Query_ method on ``self._query``.
+    def _replace_query(self, query):
+        query_maker = self._clone()
+        query_maker._query = query
+        # If the query involved a join, then the join point has changed. Update what to select.
+        query_maker._select = query_maker._joinpoint = query_maker._get_joinpoint_zero_class()
+        query_maker._select_method = Query.add_entity
+        return query_maker
+
     # Looking up a class's `Column <http://docs.sqlalchemy.org/en/latest/core/metadata.html#sqlalchemy.schema.Column>`_ or `relationship <http://docs.sqlalchemy.org/en/latest/orm/relationship_api.html#sqlalchemy.orm.relationship>`_ generates the matching query.
-    @_generative()
     def __getattr__(self, name):
-        # Find the Column_ or relationship_ in the join point class we're querying.
-        attr = getattr(self._get_joinpoint_zero_class(), name)
-        # If the attribute refers to a column, save this as a possible select statement. Note that a Column_ gets replaced with an `InstrumentedAttribute <http://docs.sqlalchemy.org/en/latest/orm/internals.html?highlight=instrumentedattribute#sqlalchemy.orm.attributes.InstrumentedAttribute>`_; see `QueryableAttribute <http://docs.sqlalchemy.org/en/latest/orm/internals.html?highlight=instrumentedattribute#sqlalchemy.orm.attributes.QueryableAttribute.property>`_.
-        if isinstance(attr.property, ColumnProperty):
-            self._select = attr
-        elif isinstance(attr.property, RelationshipProperty):
-            # Figure out what class this relationship refers to. See `mapper.params.class_ <http://docs.sqlalchemy.org/en/latest/orm/mapping_api.html?highlight=mapper#sqlalchemy.orm.mapper.params.class_>`_.
-            declarative_class = attr.property.mapper.class_
-            # Update the query by performing the implied join.
-            self._query = self._query.join(declarative_class)
-            # Save this relationship as a possible select statement.
-            self._select = declarative_class
-        else:
-            # This isn't a Column_ or a relationship_.
-            assert False
+        return self._chain(name)
+
+    # Look up several attributes in turn; see `chain_attributes`_.
+    def _chain(self, *names):
+        ops = self._ops
+        joinpoint = self._joinpoint
+        select = self._select
+        select_method = self._select_method
+        for name in names:
+            # Find the Column_ or relationship_ in the join point class we're querying. `_resolve_attribute`_ memoizes this lookup, so repeated hops such as ``.addresses`` don't re-inspect the mapper.
+            # Names written in code are already interned, but names built at runtime (for example, ``getattr(query_maker, 'email_' + 'address')``) aren't; interning them lets the cache compare keys by identity.
+            resolved = _resolve_attribute(joinpoint, sys.intern(name))
+            # If this is a relationship_, record the implied join.
+            if resolved.join is not None:
+                ops += (('join', resolved.join), )
+                joinpoint = resolved.join
+            # Save the column or relationship as a possible select statement, along with the method which selects it.
+            select = resolved.select
+            select_method = resolved.select_method
+        query_maker = self._clone()
+        query_maker._ops = ops
+        query_maker._joinpoint = joinpoint
+        query_maker._select = select
+        query_maker._select_method = select_method
+        return query_maker
 
     # Indexing the object performs the implied filter. For example, ``session(User)['jack']`` implies ``session.query(User).filter(User.name == 'jack')``.
-    @_generative()
     def __getitem__(self,
-        # Most often, this is a key which will be filtered by the ``default_query`` method of the currently-active `Declarative class`_. In the example above, the ``User`` class must define a ``default_query`` to operate on strings. However, it may also be a filter criterion, such as ``session(User)[User.name == 'jack']``.
+        # Most often, this is a key which will be filtered by the ``default_query_map`` or ``default_query`` method of the currently-active `Declarative class`_. In the example above, the ``User`` class must define one of these to operate on strings. However, it may also be a filter criterion, such as ``session(User)[User.name == 'jack']``.
         key):
 
-        # See if this is a filter criterion; if not, rely in the ``default_query`` defined by the `Declarative class`_ or fall back to the first primary key.
-        criteria = None
-        jp0_class = self._get_joinpoint_zero_class()
-        if isinstance(key, ClauseElement):
-            criteria = key
-        elif hasattr(jp0_class, 'default_query'):
-            criteria = jp0_class.default_query(key)
-        if criteria is None:
-            pks = inspect(jp0_class).primary_key
-            criteria = pks[0] == key
-        self._query = self._query.filter(criteria)
+        # Translate the key into a filter criterion, based on its type. See `_key_to_criteria`_.
+        criteria = _key_to_criteria(self._joinpoint, key)
+        query_maker = self._clone()
+        query_maker._ops = self._ops + (('filter', criteria), )
+        return query_maker
 
     # Support common syntax: ``for x in query_maker:`` converts this to a query and returns results. The session must already have been set.
     def __iter__(self):
-        return self.to_query().__iter__()
+        result = self._baked_result()
+        if result is None:
+            return self.to_query().__iter__()
+        return result.__iter__()
+
+    # Run a baked query, so that SQLAlchemy compiles each shape of query only once. The literal values from the filters become its parameters. Return ``None`` if this query can't be baked, has no session, or the session's ``query_cls`` changes how results are produced (see `_bakeable_query_cls`_).
+    def _baked_result(self):
+        session = self._session
+        if session is None or not _bakeable_query_cls(getattr(session, '_query_cls', Query)):
+            return None
+        shape, params = self._shape()
+        if shape is None:
+            return None
+        return self._baked_query(shape)(session).params(**_shape_params(params))
+
+    # Compile this query into a function which runs it with new values for its keys; see `compile_query`_.
+    def _compile(self, param_names):
+
+        shape, params = self._shape()
+        assert shape is not None, 'Only a query built from a declarative class by attributes and keys can be compiled.'
+        assert len(param_names) == len(params)
+        baked_query = self._baked_query(shape)
+
+        def run(session, *args, **kwargs):
+            values = dict(zip(param_names, args))
+            values.update(kwargs)
+            params = _shape_params([values[name] for name in param_names])
+            # As in ``_baked_result``, a baked query would bypass a ``query_cls`` which changes how results are produced. For these sessions, build an ordinary query instead.
+            if not _bakeable_query_cls(getattr(session, '_query_cls', Query)):
+                return _query_from_shape(session, shape).params(**params)
+            return baked_query(session).params(**params)
+
+        return run
+
+    # Return a `baked query <http://docs.sqlalchemy.org/en/latest/orm/extensions/baked.html>`_ for the given shape. The shape is the key for the baked query.
+    def _baked_query(self, shape):
+        return self._bakery(lambda session: _query_from_shape(session, shape), shape)
+
+    # Return the shape of this query -- the class it starts from, followed by its joins and filters with all literal values removed, then what it selects, the Query_ method which selects it, and ``strict_loading`` -- along with these literal values. Queries with the same shape produce the same SQL. If the query can't be described by a shape, return ``None`` for the shape.
+    def _shape(self):
+        if self._root_class is None:
+            return None, None
+        shape = [self._root_class]
+        params = []
+        for op, arg in self._ops:
+            if op == 'join':
+                shape.append((op, arg))
+            else:
+                filter_shape = _filter_shape(arg)
+                if filter_shape is None:
+                    return None, None
+                shape.append(filter_shape)
+                params.append(arg.right.value)
+        shape.append(self._select)
+        shape.append(self._select_method)
+        shape.append(self._strict_loading)
+        return tuple(shape), params
 
     # This property returns a `_QueryWrapper`_, a query-like object which transforms returned Query_ values back into this class while leaving other return values unchanged.
     @property
@@ -154,17 +306,53 @@ class QueryMaker(object):
         # Optionally, the `Session <http://docs.sqlalchemy.org/en/latest/orm/session_api.html?highlight=session#sqlalchemy.orm.session.Session>`_ to run this query in.
         session=None):
 
-        # If a session was specified, use it to produce the query_; otherwise, use the existing query_.
-        query = self._query.with_session(session) if session else self._query
-        # Choose the correct method to select either a column or a class (e.g. an entity). As noted earlier, a Column_ becomes and InstrumentedAttribute_.
-        if isinstance(self._select, InstrumentedAttribute):
-            return query.add_columns(self._select)
+        # Since a QueryMaker_ is never modified after it's created, the query it produces for a given session never changes. Reuse it, so that code such as ``query_maker.q.count()`` followed by ``query_maker.q.all()`` builds the query only once.
+        cached_query = self._cached_query
+        if cached_query is not None and cached_query[0] is session:
+            return cached_query[1]
+
+        # If this query started from a class and doesn't join to other classes, query what to select directly, rather than using select_from_ then adding what to select. This produces a simpler query.
+        if self._root_class is not None and all(op == 'filter' for op, arg in self._ops):
+            query_session = session or self._session
+            query = query_session.query(self._select) if query_session else Query(self._select)
+            if self._ops:
+                query = query.filter(*[arg for op, arg in self._ops])
         else:
-            return query.add_entity(self._select)
+            # If a different session was specified, use it to produce the query_; otherwise, use the existing query_. If this QueryMaker_ started from a class, build the query using the specified session, so that the query uses that session's ``query_cls``, as the query without joins above does. Otherwise, the query was provided; move it to the specified session. This avoids the copy made by ``with_session`` when the session is unchanged.
+            if session is None or session is self._session:
+                query = self._query
+            elif self._root_class is not None:
+                query = self._build_query(session)
+            else:
+                query = self._query.with_session(session)
+            # The method which adds what to select was determined when the select was looked up, so call it directly.
+            query = self._select_method(query, self._select)
+        if self._strict_loading:
+            query = query.options(raiseload('*'))
+        self._cached_query = (session, query)
+        return query
 
-    # Get the right-most join point in the current query.
+    # Return the class of the Query_ this QueryMaker_ produces, without building the query.
+    def _query_cls(self):
+        if self._base is not None:
+            return type(self._base)
+        if self._session is not None:
+            return getattr(self._session, '_query_cls', Query)
+        return Query
+
+    # Get the right-most join point in the current query, or ``None`` if the query has nothing to select from.
     def _get_joinpoint_zero_class(self):
-        jp0 = self._query._joinpoint_zero()
+        query = self._query
+        # ``Query._joinpoint_zero`` raises an exception if the query has no entities and no select_from_. Check for this directly instead of catching the exception. These are private attributes of Query_; if they're missing, fall back to catching the exception.
+        if hasattr(query, '_entities') and hasattr(query, '_select_from_entity'):
+            if not query._entities and query._select_from_entity is None:
+                return None
+            jp0 = query._joinpoint_zero()
+        else:
+            try:
+                jp0 = query._joinpoint_zero()
+            except Exception:
+                return None
         # If the join point was returned as a `Mapper <http://docs.sqlalchemy.org/en/latest/orm/mapping_api.html#sqlalchemy.orm.mapper.Mapper>`_, get the underlying class.
         if isinstance(jp0, Mapper):
             jp0 = jp0.class_
@@ -177,12 +365,15 @@ class QueryMaker(object):
 # -------------
 # This class behaves mostly like a Query_. However, if the return value of a method is a Query_, it returns a QueryMaker_ object instead. It's intended for internal use by ``QueryMaker.q``.
 class _QueryWrapper(object):
+    # As with QueryMaker_, avoid a per-instance ``__dict__``.
+    __slots__ = ('_query_maker', )
+
     def __init__(self, query_maker):
         self._query_maker = query_maker
 
     # Delegate directly to the wrapped Query_. Per `special method lookup <https://docs.python.org/3/reference/datamodel.html#special-lookup>`_, the `special method names <https://docs.python.org/3/reference/datamodel.html#special-method-names>`_ bypass ``__getattr__`` (and even ``__getattribute__``) lookup. Only override what Query_ overrides.
     #
-    # The ``_tq`` (to_query) property shortens the following functions.
+    # The ``_tq`` (to_query) property shortens the following functions. Since ``to_query`` caches the query it produces, using ``_tq`` several times builds the query only once; there's no need to cache it here as well.
     @property
     def _tq(self):
         return self._query_maker.to_query()
@@ -192,39 +383,68 @@ class _QueryWrapper(object):
         return self._tq.__str__()
     def __repr__(self):
         return self._tq.__repr__()
+    # Iterate using QueryMaker_, which can use a baked query.
     def __iter__(self):
-        return self._tq.__iter__()
+        return self._query_maker.__iter__()
 
-    # Allow ``__init__`` to create the ``_query_maker`` variable. Everything else goes to the wrapped Query_. Allow direct assignments, as this mimics what an actual Query_ instance would do.
+    # Allow ``__init__`` to create the ``_query_maker`` variable. Everything else goes to the wrapped QueryMaker_. Allow direct assignments, as this mimics what an actual Query_ instance would do. Since QueryMaker_ uses slots, only its existing fields (such as ``_query``) may be assigned.
     def __setattr__(self, name, value):
         if name != '_query_maker':
             return self._query_maker.__setattr__(name, value)
         else:
-            self.__dict__[name] = value
+            object.__setattr__(self, name, value)
 
     # Run the method on the underlying Query_. If a Query_ is returned, wrap it in a QueryMaker_.
     def __getattr__(self, name):
+        # Methods which return results, such as ``all()``, use a baked query if possible. This reuses the SQL compiled for any query of the same shape, instead of compiling the Query_ again. ``_baked_result`` returns ``None`` when the query contains bound parameters created by the caller, or when the session's ``query_cls`` overrides ``__iter__`` or this method; the method then runs on the Query_ as usual.
+        if name in _BAKED_RESULT_METHODS:
+            result = self._query_maker._baked_result()
+            if result is not None:
+                return getattr(result, name)
+
+        # If the Query_ class defines a method with this name, return a cached proxy for it. This avoids building a query just to look up the method; the proxy builds the query only when it's called.
+        if isinstance(getattr(Query, name, None), FunctionType):
+            return MethodType(_query_method_proxy(self._query_maker._query_cls(), name), self)
+
+        # Otherwise, look up the attribute on the query. This handles properties and methods defined only by a subclass of Query_.
         attr = getattr(self._tq, name)
         if not callable(attr):
             # If this isn't a function, then don't do any wrapping.
             return attr
         else:
-            def _wrap_query(*args, **kwargs):
+            return MethodType(_query_method_proxy(self._query_maker._query_cls(), name), self)
+
+
+# .. _`_query_method_proxy`:
+#
+# Return a function which invokes the named Query_ method for a `_QueryWrapper`_. The function depends only on the class of the query and the name, so create it once per class and name. (Subclasses of Query_ may define methods with the same name which return different types.)
+_QUERY_METHOD_PROXIES = {}
+
+def _query_method_proxy(query_cls, name):
+    method_proxy = _QUERY_METHOD_PROXIES.get((query_cls, name))
+    if method_proxy is None:
+        # Record if this method of ``query_cls`` returns a Query_. This is unknown until the method is first called.
+        returns_query = None
+
+        def method_proxy(query_wrapper, *args, **kwargs):
+            nonlocal returns_query
+            query_maker = query_wrapper._query_maker
+            if not returns_query:
                 # Invoke the requested Query_ method on the "completed" query returned by ``to_query``.
-                ret = attr(*args, **kwargs)
-                if isinstance(ret, Query):
-                    # If the return value was a Query_, make it generative by returning a new QueryMaker_ instance wrapping the query.
-                    query_maker = self._query_maker._clone()
-                    # Re-run getattr on the raw query, since we don't want to add columns or entities to the query yet. Otherwise, they'd be added twice (here and again when ``to_query`` is called).
-                    query_maker._query = getattr(query_maker._query, name)(*args, **kwargs)
-                    # If the query involved a join, then the join point has changed. Update what to select.
-                    query_maker._select = query_maker._get_joinpoint_zero_class()
-                    return query_maker
-                else:
-                    # Otherwise, just return the result.
+                ret = getattr(query_maker.to_query(), name)(*args, **kwargs)
+                returns_query = isinstance(ret, Query)
+                if not returns_query:
+                    # Return the result, since it's not a query.
                     return ret
+            # If this method returns a Query_, make it generative by returning a new QueryMaker_ instance wrapping the query. Run the method on the raw query, since we don't want to add columns or entities to the query yet. Otherwise, they'd be added twice (here and again when ``to_query`` is called). Once this method is known to return a Query_, this is the only place it's run.
+            return query_maker._replace_query(getattr(query_maker._query, name)(*args, **kwargs))
+
+        _QUERY_METHOD_PROXIES[query_cls, name] = method_proxy
+    return method_proxy
 
-            return _wrap_query
+
+# The methods of a `baked query result <http://docs.sqlalchemy.org/en/latest/orm/extensions/baked.html#sqlalchemy.ext.baked.Result>`_ which behave like the Query_ methods of the same name.
+_BAKED_RESULT_METHODS = {'all', 'count', 'first', 'one', 'one_or_none', 'scalar'}
 
 
 # .. _QueryMakerDeclarativeMeta:
@@ -234,7 +454,8 @@ class _QueryWrapper(object):
 # Turn indexing of a `Declarative class`_ into a query. For example, ``User['jack']`` is a query. See the `advanced examples` for an example of its use.
 class QueryMakerDeclarativeMeta(DeclarativeMeta):
     def __getitem__(cls, key):
-        return QueryMaker(cls)[key]
+        # Since a QueryMaker_ is never modified, start from a shared instance for this class instead of constructing a new one.
+        return _class_query_maker(cls)[key]
 
 
 # .. _QueryMakerQuery:
@@ -256,7 +477,7 @@ class QueryMakerQuery(Query):
 # Create a Session_ which returns a QueryMaker_ when called as a function. This enables ``session(User)['jack']``. See the `database setup` for an example of its use.
 class QueryMakerSession(Session):
     def __call__(self, declarative_class):
-        return QueryMaker(declarative_class, self.query())
+        return QueryMaker(declarative_class, session=self)
 
 
 # .. _QueryMakerScopedSession:
@@ -268,17 +489,248 @@ class QueryMakerScopedSession(scoped_session):
     # Note that the superclass' `__call__ <http://docs.sqlalchemy.org/en/latest/orm/contextual.html#sqlalchemy.orm.scoping.scoped_session.__call__>`_ method only accepts keyword arguments. So, only return a QueryMaker_ if only arguments, not keyword arguments, are given.
     def __call__(self, *args, **kwargs):
         if args and not kwargs:
-            return QueryMaker(*args, query=self.registry().query())
+            return QueryMaker(*args, session=self.registry())
         else:
             return super().__call__(*args, **kwargs)
 
 
+# cached_default_query
+# --------------------
+# Decorate a ``default_query`` method (below ``@classmethod``) or a function in ``default_query_map`` to reuse the criterion it returns for a given class and key, rather than constructing a new one on every lookup. For example:
+#
+# .. code-block:: Python3
+#   :linenos:
+#
+#   @classmethod
+#   @cached_default_query
+#   def default_query(cls, key):
+#       return cls.email_address == key
+#
+# Only keys of simple, immutable types are cached; others are passed through to the function. The function must depend only on its class and key.
+_CACHEABLE_KEY_TYPES = (str, int, bytes)
+
+def cached_default_query(function):
+    # Use ``typed=True`` so that keys such as ``1`` and ``True`` are cached separately.
+    cached_function = lru_cache(maxsize=1024, typed=True)(function)
+
+    @wraps(function)
+    def default_query(cls, key):
+        if isinstance(key, _CACHEABLE_KEY_TYPES):
+            return cached_function(cls, key)
+        return function(cls, key)
+
+    default_query.cache_clear = cached_function.cache_clear
+    return default_query
+
+
+# Helper functions
+# ----------------
+# These operate on a QueryMaker_, but aren't its methods: any attribute of a QueryMaker_ would hide a column or relationship of the same name (see `Limitations`_).
+#
+# .. _chain_attributes:
+#
+# Look up several attributes in turn: ``chain_attributes(session(User), 'addresses', 'email_address')`` is equivalent to ``session(User).addresses.email_address``, but creates only one new QueryMaker_ instead of one per attribute. This is also useful when the attribute names are only known at runtime, or to reach a column or relationship whose name is used by QueryMaker_, such as ``q``.
+def chain_attributes(query_maker, *names):
+    return query_maker._chain(*names)
+
+
+# .. _compile_query:
+#
+# Compile a query into a function which runs it with new values for its keys, avoiding the work of building the query on each use. For example, given ``find = compile_query(session(User)['jack'].addresses['jack@google.com'], 'name', 'email')``, both ``find(session, 'jack', 'j25@yahoo.com')`` and ``find(session, name='jack', email='j25@yahoo.com')`` produce the results of ``session(User)['jack'].addresses['j25@yahoo.com']``. The function returns a `baked query result <http://docs.sqlalchemy.org/en/latest/orm/extensions/baked.html#sqlalchemy.ext.baked.Result>`_ (or, if the session's ``query_cls`` overrides how results are produced, a Query_), which may be iterated over or used to call methods such as ``all()`` or ``first()``.
+def compile_query(query_maker,
+    # The names of the query's keys, in the order they appear in the query.
+    *param_names):
+
+    return query_maker._compile(param_names)
+
+
+# Discard all cached queries and lookups. This is mostly useful for tests.
+def cache_clear():
+    QueryMaker._bakery.cache.clear()
+    for cached_function in (_resolve_class_attribute, _default_query_map, _default_query_for_type, _has_default_query, _primary_key, _class_query_maker, _starter_query, _bakeable_query_cls):
+        cached_function.cache_clear()
+    _QUERY_METHOD_PROXIES.clear()
+    # Keep only the entries which ``_KEY_TO_CRITERIA`` started with.
+    _KEY_TO_CRITERIA.clear()
+    _KEY_TO_CRITERIA.update(_BASE_KEY_TO_CRITERIA)
+
+
 # Support routines
 # ----------------
-# Copied from https://stackoverflow.com/a/7662943.
+# Create a QueryMaker_ for a `Declarative class`_ the first time it's needed, then reuse it. A QueryMaker_ refers to its class, so this can't use `_cache_per_class`_; bound the size of the cache instead.
+@lru_cache(maxsize=1024)
+def _class_query_maker(declarative_class):
+    return QueryMaker(declarative_class)
+
+
+# Likewise, create the empty query which selects from a `Declarative class`_ once. Since Query_ methods return a modified copy, this query is never changed, so all QueryMaker_ instances starting from this class without a session can share it. (A query with a session must come from that session, in order to use its ``query_cls``.)
+@lru_cache(maxsize=1024)
+def _starter_query(declarative_class):
+    return Query([]).select_from(declarative_class)
+
+
+# Return the shape of a filter criterion: a comparison between a Column_ and a literal value, such as ``User.name == 'jack'``, is recorded as the column, operator, and type of the value. Any other criterion returns ``None``, since its shape can't be recorded. In particular, only an anonymous bound parameter (which SQLAlchemy creates for a literal value) may be replaced by a parameter of the baked query; a parameter the user created, such as ``bindparam('name')`` or an expanding parameter used by ``in_``, must be left as is.
+def _filter_shape(criteria):
+    if (isinstance(criteria, BinaryExpression) and
+        isinstance(criteria.left, Column) and
+        isinstance(criteria.right, BindParameter) and
+        criteria.right.unique and
+        not criteria.right.expanding and
+        not criteria.right.required and
+        criteria.right.callable is None and
+        not criteria.modifiers):
+
+        return ('filter', criteria.left, criteria.operator, criteria.right.type)
+
+
+# .. _`_bakeable_query_cls`:
+#
+# A baked query produces results by executing the query directly, bypassing any ``__iter__`` or result method (such as ``all``; see ``_BAKED_RESULT_METHODS``) which a session's ``query_cls`` overrides -- for example, to apply a filter to every query. Only bake queries for a ``query_cls`` which doesn't override these.
+@lru_cache(maxsize=64)
+def _bakeable_query_cls(query_cls):
+    return all(getattr(query_cls, name) is getattr(Query, name) for name in ('__iter__', ) + tuple(_BAKED_RESULT_METHODS))
+
+
+# Name the parameters of a baked query.
+def _shape_params(params):
+    return {'_qm_param_{}'.format(index): value for index, value in enumerate(params)}
+
+
+# Build the query described by a shape, replacing literal values with bound parameters.
+def _query_from_shape(session, shape):
+    steps = shape[1:-3]
+    select, select_method = shape[-3:-1]
+    # As in ``to_query``, only use ``select_from`` if the query contains joins.
+    has_joins = any(step[0] == 'join' for step in steps)
+    query = session.query().select_from(shape[0]) if has_joins else session.query(select)
+    index = 0
+    for step in steps:
+        if step[0] == 'join':
+            query = query.join(step[1])
+        else:
+            _, column, operator, type_ = step
+            query = query.filter(operator(column, bindparam('_qm_param_{}'.format(index), type_=type_)))
+            index += 1
+    if has_joins:
+        query = select_method(query, select)
+    return query.options(raiseload('*')) if shape[-1] else query
+
+
+# .. _`_key_to_criteria`:
+#
+# Translate the key used to index a QueryMaker_ into a filter criterion. A filter criterion is used as is.
+def _clause_to_criteria(declarative_class, key):
+    return key
+
+
+# Otherwise, rely on the ``default_query_map`` or ``default_query`` defined by the `Declarative class`_ or fall back to the first primary key.
+def _value_to_criteria(declarative_class, key):
+    criteria = None
+    to_criteria = _default_query_for_type(declarative_class, type(key))
+    if to_criteria:
+        criteria = to_criteria(declarative_class, key)
+    elif _has_default_query(declarative_class):
+        criteria = declarative_class.default_query(key)
+    if criteria is None:
+        criteria = _primary_key(declarative_class) == key
+    return criteria
+
+
+# .. _`_cache_per_class`:
+#
+# Cache a function of a `Declarative class`_ and, optionally, further arguments. The cache holds only a weak reference to each class, so that it doesn't keep classes alive; for the same reason, the cached value must not refer to the class. These caches are filled on first use instead of when a class is created, since a class's mapper may not be fully configured until then.
+#
+# The join point of a query may also be an alias of a class, for example after ``.q.join(aliased(Address))``. Each alias is a new object, so caching it would only fill the cache with entries that are never used again; call the function directly instead.
+_MISSING = object()
+
+def _cache_per_class(function):
+    cache = WeakKeyDictionary()
+
+    @wraps(function)
+    def cached_function(declarative_class, *args):
+        if not isinstance(declarative_class, type):
+            return function(declarative_class, *args)
+        class_cache = cache.get(declarative_class)
+        if class_cache is None:
+            class_cache = cache[declarative_class] = {}
+        value = class_cache.get(args, _MISSING)
+        if value is _MISSING:
+            value = class_cache[args] = function(declarative_class, *args)
+        return value
+
+    cached_function.cache_clear = cache.clear
+    return cached_function
+
+
+# The lookups below use these caches.
+#
+# A `Declarative class`_ may define ``default_query_map``, a dict which maps the type of a key to a function ``f(cls, key)`` returning the filter criterion for that key; for example, ``default_query_map = {str: lambda cls, key: cls.name == key}``. This avoids calling ``default_query``, which must then check the key's type itself.
+@_cache_per_class
+def _default_query_map(declarative_class):
+    return getattr(declarative_class, 'default_query_map', {})
+
+
+# Find the function in ``default_query_map`` for a type of key. As with ``isinstance``, a key whose type is a subclass of a type in the map (for example, a subclass of ``str``) uses that type's function; search the key type's base classes in method resolution order. Cache the result for each class and key type, so that most lookups don't search.
+@_cache_per_class
+def _default_query_for_type(declarative_class, key_type):
+    default_query_map = _default_query_map(declarative_class)
+    return next((default_query_map[base] for base in key_type.__mro__ if base in default_query_map), None)
+
+
+# Determine if a class defines ``default_query`` once, instead of using ``hasattr`` on each index.
+@_cache_per_class
+def _has_default_query(declarative_class):
+    return hasattr(declarative_class, 'default_query')
+
+
+# Look up the first primary key of a `Declarative class`_ once, rather than inspecting its mapper on each index.
+@_cache_per_class
+def _primary_key(declarative_class):
+    return inspect(declarative_class).primary_key[0]
+
+
+# Choose between these based on the type of the key. Rather than a chain of ``isinstance`` checks on each index, look up the key's type in this dict. When a type isn't found, search its base classes, then add it to the dict so the next lookup succeeds directly.
+_BASE_KEY_TO_CRITERIA = {
+    ClauseElement: _clause_to_criteria,
+}
+_KEY_TO_CRITERIA = dict(_BASE_KEY_TO_CRITERIA)
+
+def _key_to_criteria(declarative_class, key):
+    key_type = type(key)
+    to_criteria = _KEY_TO_CRITERIA.get(key_type)
+    if to_criteria is None:
+        to_criteria = next((_KEY_TO_CRITERIA[base] for base in key_type.__mro__ if base in _KEY_TO_CRITERIA), _value_to_criteria)
+        _KEY_TO_CRITERIA[key_type] = to_criteria
+    return to_criteria(declarative_class, key)
+
+
+# .. _`_resolve_attribute`:
+#
+# Translate an attribute of a `Declarative class`_ into what QueryMaker_ should select, the Query_ method which selects it, and, for a relationship_, the class to join to. The result depends only on the class and the attribute name, so cache it; this turns each ``.attr`` hop of a query into a dict lookup. As in `_cache_per_class`_, don't cache the attributes of an alias.
+_ResolvedAttribute = namedtuple('_ResolvedAttribute', 'select select_method join')
+
+def _resolve_attribute(joinpoint, name):
+    if isinstance(joinpoint, type):
+        return _resolve_class_attribute(joinpoint, name)
+    return _resolve_class_attribute.__wrapped__(joinpoint, name)
+
+
+# Since the result refers to the class (an InstrumentedAttribute_ refers to its class, as does a relationship_'s target), a weak-keyed cache would never release it. Instead, bound the size of this cache.
+@lru_cache(maxsize=4096)
+def _resolve_class_attribute(declarative_class, name):
+    attr = getattr(declarative_class, name)
+    # If the attribute refers to a column, select it. Note that a Column_ gets replaced with an `InstrumentedAttribute <http://docs.sqlalchemy.org/en/latest/orm/internals.html?highlight=instrumentedattribute#sqlalchemy.orm.attributes.InstrumentedAttribute>`_; see `QueryableAttribute <http://docs.sqlalchemy.org/en/latest/orm/internals.html?highlight=instrumentedattribute#sqlalchemy.orm.attributes.QueryableAttribute.property>`_.
+    if isinstance(attr.property, ColumnProperty):
+        return _ResolvedAttribute(attr, Query.add_columns, None)
+    elif isinstance(attr.property, RelationshipProperty):
+        # Figure out what class this relationship refers to. See `mapper.params.class_ <http://docs.sqlalchemy.org/en/latest/orm/mapping_api.html?highlight=mapper#sqlalchemy.orm.mapper.params.class_>`_. Both join to and select this class.
+        declarative_class = attr.property.mapper.class_
+        return _ResolvedAttribute(declarative_class, Query.add_entity, declarative_class)
+    else:
+        # This isn't a Column_ or a relationship_.
+        assert False
+
+
+# Determine if ``cls`` is a mapped class. Originally based on https://stackoverflow.com/a/7662943, which catches the exception raised by ``class_mapper``; instead, `inspect <http://docs.sqlalchemy.org/en/latest/core/inspection.html#sqlalchemy.inspection.inspect>`_ with ``raiseerr=False`` returns a ``Mapper`` only for a mapped class, without raising and catching an exception. This runs each time a QueryMaker_ is created.
 def _is_mapped_class(cls):
-    try:
-        class_mapper(cls)
-        return True
-    except:
-        return False
+    return isinstance(inspect(cls, raiseerr=False), Mapper)
@@ -48,8 +48,8 @@ class QueryMakerFlaskDeclarativeMeta(DefaultMeta):
     def __getitem__(cls, key):
         # Extract the session from the Flask-SQLAlchemy `query <http://flask-sqlalchemy.pocoo.org/2.3/queries/#querying-records>`_ attribute.
         session = cls.query.session
-        # Build a new query from here, since ``cls.query`` has already invoked ``add_entity`` on ``cls``.
-        return QueryMaker(cls, session.query())[key]
+        # Build a new query using this session, since ``cls.query`` has already invoked ``add_entity`` on ``cls``.
+        return QueryMaker(cls, session=session)[key]
 
 
 # Then, use this in the `Flask-SQLAlchemy session <http://flask-sqlalchemy.pocoo.org/2.3/api/#sessions>`_.
@@ -25,12 +25,13 @@
 # Third-party imports
 # -------------------
 from flask import Flask
+import pytest
 from sqlalchemy.sql.expression import func
 
 # Local imports
 # -------------
 from pythonic_sqlalchemy_query.flask import SQLAlchemyPythonicQuery
-from util import print_query
+from util import print_query, fast_sqlite
 
 # Setup
 # =====
@@ -39,6 +40,7 @@ app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemyPythonicQuery(app)
+fast_sqlite(db.engine)
 
 # Model
 # -----
@@ -48,17 +50,17 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String)
     fullname = db.Column(db.String)
-    password = db.Column(db.String)
+    # Don't load the password unless it's accessed. This avoids sending it with every query for a User.
+    password = db.deferred(db.Column(db.String))
 
-    # Define a default query which assumes the key is a User's name if given a string.
-    @classmethod
-    def default_query(cls, key):
-        if isinstance(key, str):
-            return cls.name == key
+    # Define a default query which assumes the key is a User's name if given a string. Other types of keys fall back to the primary key. Looking up the key's type in this dict avoids an ``isinstance`` check in a ``default_query`` method.
+    default_query_map = {
+        str: lambda cls, key: cls.name == key,
+    }
 
     def __repr__(self):
-       return "<User(name='%s', fullname='%s', password='%s')>" % (
-                            self.name, self.fullname, self.password)
+       # Omit the deferred password; including it would cause another query to load it.
+       return f"<User(name='{self.name}', fullname='{self.fullname}')>"
 
 class Address(db.Model):
     __tablename__ = 'addresses'
@@ -66,7 +68,8 @@ class Address(db.Model):
     email_address = db.Column(db.String, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
 
-    user = db.relationship("User", back_populates="addresses")
+    # Each Address has only one User, so load it in the same SELECT using a `joined eager load <http://docs.sqlalchemy.org/en/latest/orm/loading_relationships.html#joined-eager-loading>`_.
+    user = db.relationship("User", back_populates="addresses", lazy='joined')
 
     # Define a default query which assumes the key is an Address's e-mail address.
     @classmethod
@@ -74,22 +77,31 @@ class Address(db.Model):
         return cls.email_address == key
 
     def __repr__(self):
-        return "<Address(email_address='%s')>" % self.email_address
+        return f"<Address(email_address='{self.email_address}')>"
 
+# Load related objects using a `SELECT IN <http://docs.sqlalchemy.org/en/latest/orm/loading_relationships.html#select-in-loading>`_ rather than the default of a SELECT per object, avoiding the N+1 problem when iterating over the results of a query.
 User.addresses = db.relationship(
-    "Address", order_by=Address.id, back_populates="user")
+    "Address", order_by=Address.id, back_populates="user", lazy='selectin')
 
 # Create all tables.
 db.create_all()
 #
 # Test data
 # ---------
-jack = User(name='jack', fullname='Jack Bean', password='gjffdd')
-jack.addresses = [
-                  Address(email_address='jack@google.com'),
-                  Address(email_address='j25@yahoo.com')]
-db.session.add(jack)
+# Insert the rows directly, rather than creating objects then flushing them through the ORM's unit of work.
+db.session.execute(User.__table__.insert(), [
+    dict(id=1, name='jack', fullname='Jack Bean', password='gjffdd'),
+])
+db.session.execute(Address.__table__.insert(), [
+    dict(user_id=1, email_address='jack@google.com'),
+    dict(user_id=1, email_address='j25@yahoo.com'),
+])
 db.session.commit()
+# Load jack; this also loads his addresses.
+jack = User.query.get(1)
+
+# A query for the Address jack@google.com of the User jack. A QueryMaker is never modified, so it can be built once and shared. Pass it to ``print_query`` along with its source, so that the source is printed.
+Q_JACK_GMAIL = User['jack'].addresses['jack@google.com']
 
 # .. _Flask Demonstration and unit tests:
 #
@@ -102,8 +114,7 @@ def test_traditional_versus_pythonic():
     # Create a query to select the Address for 'jack@google.com' from User 'jack'.
     #
     # The Pythonic version of a query:
-    pythonic_query = "User['jack'].addresses['jack@google.com']"
-    print_query(pythonic_query, [jack.addresses[0]], globals())
+    print_query((Q_JACK_GMAIL, "User['jack'].addresses['jack@google.com']"), [jack.addresses[0]])
 
     # The traditional approach:
     traditional_query = (
@@ -118,43 +129,56 @@ def test_traditional_versus_pythonic():
 
 # Examples
 # --------
-def test_more_examples():
+# Each of these examples is a separate test, so that a failure in one doesn't hide the rest, and so that they can be run in parallel (for example, using `pytest-xdist <https://pypi.org/project/pytest-xdist/>`_).
+MORE_EXAMPLES = [
     # Ask for the full User object for jack.
-    print_query("User['jack']", [jack], globals())
+    ("User['jack']", [jack]),
     # Ask only for Jack's full name.
-    print_query("User['jack'].fullname", [(jack.fullname, )], globals())
+    ("User['jack'].fullname", [(jack.fullname, )]),
     # Get all of Jack's addresses.
-    print_query("User['jack'].addresses", jack.addresses, globals())
+    ("User['jack'].addresses", jack.addresses),
     # Get just the email-address of all of Jack's addresses.
-    print_query("User['jack'].addresses.email_address", [(x.email_address, ) for x in jack.addresses], globals())
+    ("User['jack'].addresses.email_address", [(x.email_address, ) for x in jack.addresses]),
     # Get just the email-address j25@yahoo.com of Jack's addresses.
-    print_query("User['jack'].addresses['j25@yahoo.com']", [jack.addresses[1]], globals())
+    ("User['jack'].addresses['j25@yahoo.com']", [jack.addresses[1]]),
     # Ask for the full Address object for j25@yahoo.com.
-    print_query("Address['j25@yahoo.com']", [jack.addresses[1]], globals())
+    ("Address['j25@yahoo.com']", [jack.addresses[1]]),
     # Ask for the User associated with this address.
-    print_query("Address['j25@yahoo.com'].user", [jack], globals())
+    ("Address['j25@yahoo.com'].user", [jack]),
     # Use a filter criterion to select a User with a full name of Jack Bean.
-    print_query("User[User.fullname == 'Jack Bean']", [jack], globals())
+    ("User[User.fullname == 'Jack Bean']", [jack]),
     # Use two filter criteria to find the user named jack with a full name of Jack Bean.
-    print_query("User['jack'][User.fullname == 'Jack Bean']", [jack], globals())
+    ("User['jack'][User.fullname == 'Jack Bean']", [jack]),
     # Look for the user with id 1.
-    print_query("User[1]", [jack], globals())
+    ("User[1]", [jack]),
     # Use an SQL expression in the query.
-    print_query("User[func.lower(User.fullname) == 'jack bean']", [jack], globals())
+    ("User[func.lower(User.fullname) == 'jack bean']", [jack]),
     # Ask for everything in User. (This is built in to Flask-SQLAlchemy and isn't a part of this package. However, this seems like the cleanest syntax to me.)
-    print_query("User.query", [jack], globals())
+    ("User.query", [jack]),
     # Another syntax for the everything in User. This does use functionality from this package.
-    print_query("db.session(User)", [jack], globals())
+    ("db.session(User)", [jack]),
     # Ask for the name of all Users. Note that ``User.name`` can't be used in this case -- this refers to the ``name`` attribute of the ``User`` class.
-    print_query("db.session(User).name", [(jack.name, )], globals())
+    ("db.session(User).name", [(jack.name, )]),
 
     # Query using the session. A bit longer, but it produces the same results. For comparison:
-    print_query(           " User['jack'].addresses['jack@google.com']", [jack.addresses[0]], globals())
-    print_query("db.session(User)['jack'].addresses['jack@google.com']", [jack.addresses[0]], globals())
+    (           " User['jack'].addresses['jack@google.com']", [jack.addresses[0]]),
+    ("db.session(User)['jack'].addresses['jack@google.com']", [jack.addresses[0]]),
+]
+
+@pytest.mark.parametrize('str_query, expected_result', MORE_EXAMPLES)
+def test_more_examples(str_query, expected_result):
+    print_query(str_query, expected_result, globals())
+
+# Flask-SQLAlchemy's query methods, such as ``paginate`` and ``first_or_404``, work on the ``.q`` of a query, including one with joins.
+def test_flask_query_methods():
+    assert User['jack'].addresses.q.paginate(1, 10).items == jack.addresses
+    assert db.session(User)['jack'].addresses.q.first_or_404() == jack.addresses[0]
 
 # main
 # ====
 # Run the example code. This can also be `tested using pytest <pytest syntax>`.
 if __name__ == '__main__':
     test_traditional_versus_pythonic()
-    test_more_examples()
+    for str_query, expected_result in MORE_EXAMPLES:
+        test_more_examples(str_query, expected_result)
+    test_flask_query_methods()
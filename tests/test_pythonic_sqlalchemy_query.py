@@ -26,20 +26,25 @@ from pprint import pprint
 
 # Third-party imports
 # -------------------
+import pytest
 from sqlalchemy import create_engine, ForeignKey, Column, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, deferred
 from sqlalchemy.orm import aliased
 from sqlalchemy.ext import baked
 from sqlalchemy.sql.expression import bindparam
 from sqlalchemy.sql.expression import func
+from sqlalchemy.exc import InvalidRequestError, StatementError
+from sqlalchemy.pool import StaticPool
 
 # Local imports
 # -------------
 from pythonic_sqlalchemy_query import (
-    QueryMaker, QueryMakerDeclarativeMeta, QueryMakerQuery, QueryMakerSession
+    QueryMaker, QueryMakerDeclarativeMeta, QueryMakerQuery, QueryMakerSession,
+    cached_default_query, chain_attributes, compile_query, cache_clear
 )
-from util import print_query, _print_query
+from pythonic_sqlalchemy_query.core import _resolve_class_attribute
+from util import print_query, _print_query, capture_sql, fast_sqlite
 
 # Setup
 # =====
@@ -47,11 +52,20 @@ from util import print_query, _print_query
 #
 # Database setup
 # --------------
-engine = create_engine('sqlite:///:memory:')#, echo=True)
+# All tests in this module share this engine and session, rather than creating their own, so that SQL compiled for one test is reused by the others. `QueryMaker` keeps compiled SQL in its `baked query <http://docs.sqlalchemy.org/en/latest/orm/extensions/baked.html>`_ cache, which is global, not per-engine.
+#
+# Use a single connection to the in-memory database for all threads, via `StaticPool <http://docs.sqlalchemy.org/en/latest/core/pooling.html#sqlalchemy.pool.StaticPool>`_. (Flask-SQLAlchemy does this automatically for an in-memory SQLite database.)
+engine = create_engine('sqlite:///:memory:', connect_args={'check_same_thread': False}, poolclass=StaticPool)#, echo=True)
+fast_sqlite(engine)
 # The `QueryMakerSession` allows syntax such as ``session(User)...``. For typical use, you may omit the ``query_cls=QueryMakerQuery``. See `sessionmaker <http://docs.sqlalchemy.org/en/latest/orm/session_api.html?highlight=sessionmaker#sqlalchemy.orm.session.sessionmaker>`_, `query_cls <http://docs.sqlalchemy.org/en/latest/orm/session_api.html?highlight=sessionmaker#sqlalchemy.orm.session.Session.params.query_cls>`_, and `class_ <http://docs.sqlalchemy.org/en/latest/orm/session_api.html?highlight=sessionmaker#sqlalchemy.orm.session.Session.params.class_>`_.
 Session = sessionmaker(bind=engine, query_cls=QueryMakerQuery, class_=QueryMakerSession)
 session = Session()
 
+# .. _bakery:
+#
+# Create one bakery for the whole module, rather than one per test, so that baked queries are cached across tests. Iterating over a `QueryMaker` needs no bakery; it uses its own.
+bakery = baked.bakery(size=200)
+
 # Model
 # -----
 # Use the `QueryMakerDeclarativeMeta` in our `declarative class <http://docs.sqlalchemy.org/en/latest/orm/tutorial.html#declare-a-mapping>`_ definitions.
@@ -64,17 +78,17 @@ class User(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String)
     fullname = Column(String)
-    password = Column(String)
+    # Don't load the password unless it's accessed. This avoids sending it with every query for a User.
+    password = deferred(Column(String))
 
-    # Define a default query which assumes the key is a User's name if given a string.
-    @classmethod
-    def default_query(cls, key):
-        if isinstance(key, str):
-            return cls.name == key
+    # Define a default query which assumes the key is a User's name if given a string. Other types of keys fall back to the primary key.
+    default_query_map = {
+        str: lambda cls, key: cls.name == key,
+    }
 
     def __repr__(self):
-       return "<User(name='%s', fullname='%s', password='%s')>" % (
-                            self.name, self.fullname, self.password)
+       # Omit the deferred password; including it would cause another query to load it.
+       return f"<User(name='{self.name}', fullname='{self.fullname}')>"
 
 class Address(Base):
     __tablename__ = 'addresses'
@@ -82,30 +96,41 @@ class Address(Base):
     email_address = Column(String, nullable=False)
     user_id = Column(Integer, ForeignKey('users.id'))
 
-    user = relationship("User", back_populates="addresses")
+    # Each Address has only one User, so load it in the same SELECT using a `joined eager load <http://docs.sqlalchemy.org/en/latest/orm/loading_relationships.html#joined-eager-loading>`_.
+    user = relationship("User", back_populates="addresses", lazy='joined')
 
-    # Define a default query which assumes the key is an Address's e-mail address.
+    # Define a default query which assumes the key is an Address's e-mail address. Reuse the resulting criterion for each e-mail address.
     @classmethod
+    @cached_default_query
     def default_query(cls, key):
         return cls.email_address == key
 
     def __repr__(self):
-        return "<Address(email_address='%s')>" % self.email_address
+        return f"<Address(email_address='{self.email_address}')>"
 
+# Load related objects using a `SELECT IN <http://docs.sqlalchemy.org/en/latest/orm/loading_relationships.html#select-in-loading>`_ rather than the default of a SELECT per object, avoiding the N+1 problem when iterating over the results of a query.
 User.addresses = relationship(
-    "Address", order_by=Address.id, back_populates="user")
+    "Address", order_by=Address.id, back_populates="user", lazy='selectin')
 
 # Create all tables.
 Base.metadata.create_all(engine)
 
 # Test data
 # ---------
-jack = User(name='jack', fullname='Jack Bean', password='gjffdd')
-jack.addresses = [
-                  Address(email_address='jack@google.com'),
-                  Address(email_address='j25@yahoo.com')]
-session.add(jack)
+# Insert the rows directly, rather than creating objects then flushing them through the ORM's unit of work.
+session.execute(User.__table__.insert(), [
+    dict(id=1, name='jack', fullname='Jack Bean', password='gjffdd'),
+])
+session.execute(Address.__table__.insert(), [
+    dict(user_id=1, email_address='jack@google.com'),
+    dict(user_id=1, email_address='j25@yahoo.com'),
+])
 session.commit()
+# Load jack; this also loads his addresses.
+jack = session.query(User).get(1)
+
+# Several tests ask for the Address jack@google.com of the User jack. A `QueryMaker` is never modified, so build this query once and share it.
+Q_JACK_GMAIL = session(User)['jack'].addresses['jack@google.com']
 
 # .. _Demonstration and unit tests:
 #
@@ -118,8 +143,7 @@ def test_traditional_versus_pythonic():
     # Create a query to select the Address for 'jack@google.com' from User 'jack'.
     #
     # The Pythonic version of a query:
-    pythonic_query = "session(User)['jack'].addresses['jack@google.com']"
-    print_query(pythonic_query, [jack.addresses[0]], globals())
+    print_query((Q_JACK_GMAIL, "session(User)['jack'].addresses['jack@google.com']"), [jack.addresses[0]])
 
     # The traditional approach:
     traditional_query = (
@@ -134,48 +158,60 @@ def test_traditional_versus_pythonic():
 
 # More examples
 # -------------
-def test_more_examples():
+# Each of these examples is a separate test, so that a failure in one doesn't hide the rest, and so that they can be run in parallel (for example, using `pytest-xdist <https://pypi.org/project/pytest-xdist/>`_).
+MORE_EXAMPLES = [
     # Ask for the full User object for jack.
-    print_query("session(User)['jack']", [jack], globals())
+    ("session(User)['jack']", [jack]),
     # Ask only for Jack's full name.
-    print_query("session(User)['jack'].fullname", [(jack.fullname, )], globals())
+    ("session(User)['jack'].fullname", [(jack.fullname, )]),
     # Get all of Jack's addresses.
-    print_query("session(User)['jack'].addresses", jack.addresses, globals())
+    ("session(User)['jack'].addresses", jack.addresses),
     # Get just the email-address of all of Jack's addresses.
-    print_query("session(User)['jack'].addresses.email_address", [(x.email_address, ) for x in jack.addresses], globals())
+    ("session(User)['jack'].addresses.email_address", [(x.email_address, ) for x in jack.addresses]),
+    # Do the same, looking up both attributes at once.
+    ("chain_attributes(session(User)['jack'], 'addresses', 'email_address')", [(x.email_address, ) for x in jack.addresses]),
     # Get just the email-address j25@yahoo.com of Jack's addresses.
-    print_query("session(User)['jack'].addresses['j25@yahoo.com']", [jack.addresses[1]], globals())
+    ("session(User)['jack'].addresses['j25@yahoo.com']", [jack.addresses[1]]),
     # Ask for the full Address object for j25@yahoo.com.
-    print_query("session(Address)['j25@yahoo.com']", [jack.addresses[1]], globals())
+    ("session(Address)['j25@yahoo.com']", [jack.addresses[1]]),
     # Ask for the User associated with this address.
-    print_query("session(Address)['j25@yahoo.com'].user", [jack], globals())
+    ("session(Address)['j25@yahoo.com'].user", [jack]),
     # Use a filter criterion to select a User with a full name of Jack Bean.
-    print_query("session(User)[User.fullname == 'Jack Bean']", [jack], globals())
+    ("session(User)[User.fullname == 'Jack Bean']", [jack]),
     # Use two filter criteria to find the user named jack with a full name of Jack Bean.
-    print_query("session(User)['jack'][User.fullname == 'Jack Bean']", [jack], globals())
+    ("session(User)['jack'][User.fullname == 'Jack Bean']", [jack]),
     # Look for the user with id 1.
-    print_query("session(User)[1]", [jack], globals())
+    ("session(User)[1]", [jack]),
     # Use an SQL expression in the query.
-    print_query("session(User)[func.lower(User.fullname) == 'jack bean']", [jack], globals())
+    ("session(User)[func.lower(User.fullname) == 'jack bean']", [jack]),
     # Ask for all Users.
-    print_query("session(User)", [jack], globals())
+    ("session(User)", [jack]),
     # Ask for the name of all Users.
-    print_query("session(User).name", [(jack.name, )], globals())
+    ("session(User).name", [(jack.name, )]),
+]
 
+@pytest.mark.parametrize('str_query, expected_result', MORE_EXAMPLES)
+def test_more_examples(str_query, expected_result):
+    print_query(str_query, expected_result, globals())
+
+# These examples call methods of the underlying Query using ``.q``, or need more than a single query string.
+def test_query_examples():
+    # Look up the module's globals once for all the queries below.
+    globals_ = globals()
     # Transform to a query for indexing.
-    assert _print_query("session(Address).q[1]", globals()) == jack.addresses[1]
+    assert _print_query("session(Address).q[1]", globals_) == jack.addresses[1]
     # Call the ``count`` method on the underlying Query object.
-    assert _print_query("session(Address).q.count()", globals()) == 2
+    assert _print_query("session(Address).q.count()", globals_) == 2
     # Call the ``order_by`` method on the underlying Query object.
-    print_query("session(Address).q.order_by(Address.email_address)", list(reversed([jack.addresses][0])), globals())
+    print_query("session(Address).q.order_by(Address.email_address)", list(reversed([jack.addresses][0])), globals_)
     # Use the underlying query object for complex joins.
     adalias1 = aliased(Address)
-    print_query("session(User).q.join(adalias1, User.addresses)['j25@yahoo.com']", [jack.addresses[1]], globals(), locals())
+    print_query("session(User).q.join(adalias1, User.addresses)['j25@yahoo.com']", [jack.addresses[1]], globals_, locals())
 
     # Queries are generative: ``qm`` can be re-used.
     qm = session(User)['jack']
-    print_query("qm.addresses", jack.addresses, globals(), locals())
-    print_query("qm", [jack], globals(), locals())
+    print_query("qm.addresses", jack.addresses, globals_, locals())
+    print_query("qm", [jack], globals_, locals())
 
     # Properties and variables can be accessed as usual.
     cds_str = "session(User)['jack'].fullname.q.column_descriptions"
@@ -191,34 +227,133 @@ def test_more_examples():
 # Advanced examples
 # -----------------
 def test_advanced_examples():
+    # Look up the module's globals once for all the queries below.
+    globals_ = globals()
     # Specify exactly what to return by accessing the underlying query.
-    print_query("session(User)['jack'].addresses._query.add_columns(User.id, Address.id)", [(1, 1), (1, 2)], globals() )
+    print_query("session(User)['jack'].addresses._query.add_columns(User.id, Address.id)", [(1, 1), (1, 2)], globals_ )
 
     # If `QueryMakerSession` isn't used, the session can be provided at the end of the query. However, this means the ``.q`` property won't be useful (since it has no assigned session).
-    print_query("User['jack'].to_query(session)", [jack], globals())
+    print_query("User['jack'].to_query(session)", [jack], globals_)
 
     # If the `QueryMakerDeclarativeMeta` metaclass wasn't used, this performs the equivalent of ``User['jack']`` manually.
-    print_query("QueryMaker(User)['jack'].to_query(session)", [jack], globals())
+    print_query("QueryMaker(User)['jack'].to_query(session)", [jack], globals_)
 
     # Add to an existing query: first, find the User named jack.
     q = session.query().select_from(User).filter(User.name == 'jack')
     # Then ask for the Address for jack@google.com.
-    print_query("q.query_maker().addresses['jack@google.com']", [jack.addresses[0]], globals(), locals())
+    print_query("q.query_maker().addresses['jack@google.com']", [jack.addresses[0]], globals_, locals())
     # Do the same manually (without relying on the `QueryMakerQuery` ``query_maker`` method).
-    print_query("QueryMaker(query=q).addresses['jack@google.com']", [jack.addresses[0]], globals(), locals())
+    print_query("QueryMaker(query=q).addresses['jack@google.com']", [jack.addresses[0]], globals_, locals())
+    # If the existing query doesn't select from anything, provide the class to query.
+    print_query("QueryMaker(User, query=session.query())['jack']", [jack], globals_)
 
-    # `Baked queries <http://docs.sqlalchemy.org/en/latest/orm/extensions/baked.html>`_ are supported.
-    bakery = baked.bakery()
+    # `Baked queries <http://docs.sqlalchemy.org/en/latest/orm/extensions/baked.html>`_ are supported. See the `bakery`_.
     baked_query = bakery(lambda session: session(User))
     baked_query += lambda query: query[User.name == bindparam('username')]
     # The last item in the query must end with a ``.q``. Note that this doesn't print nicely. Using ``.to_query()`` instead fixes this.
     baked_query += lambda query: query.q.order_by(User.id).q
-    print_query("baked_query(session).params(username='jack', email='jack@google.com')", [jack], globals(), locals())
+    print_query("baked_query(session).params(username='jack', email='jack@google.com')", [jack], globals_, locals())
+
+    # Iterating over a QueryMaker uses a baked query internally, so queries which differ only in their keys share the same compiled SQL.
+    assert list(session(User)['jack'].addresses['jack@google.com']) == [jack.addresses[0]]
+    assert list(session(User)['jack'].addresses['j25@yahoo.com']) == [jack.addresses[1]]
+
+    # Deferred columns, such as ``User.password``, aren't loaded by a query.
+    assert 'password' not in str(session(User)['jack'].q)
+
+    # Compile a query into a function which runs it with new keys.
+    find_address = compile_query(session(User)['jack'].addresses['jack@google.com'], 'name', 'email')
+    assert find_address(session, 'jack', 'j25@yahoo.com').all() == [jack.addresses[1]]
+    assert find_address(session, name='jack', email='jack@google.com').all() == [jack.addresses[0]]
+
+    # With ``strict_loading``, accessing a relationship which the query didn't load raises an exception instead of emitting another SELECT. Use a new session, since ``jack`` and his addresses are already loaded in ``session``.
+    strict_session = Session()
+    strict_jack = list(QueryMaker(User, session=strict_session, strict_loading=True)['jack'])[0]
+    with pytest.raises(InvalidRequestError):
+        strict_jack.addresses
+    strict_session.close()
+
+# Regression tests
+# ----------------
+# These tests check details of how QueryMaker builds, caches, and runs queries. Unlike the examples above, they're not intended as documentation.
+def test_regressions():
+    # Look up the module's globals once for all the queries below.
+    globals_ = globals()
+
+    # A query produces a single SELECT, which applies all its filters in one WHERE clause over the joined tables. This lets the database apply each filter directly to its table, instead of filtering the results of a subquery.
+    with capture_sql(engine) as statements:
+        list(Q_JACK_GMAIL)
+    assert len(statements) == 1
+    assert 'FROM users JOIN addresses ON users.id = addresses.user_id' in statements[0]
+    assert 'WHERE users.name = ? AND addresses.email_address = ?' in statements[0]
+
+    # Only literal values are replaced in a baked query; bound parameters created by the caller are left as is. So, a parameter without a value is an error, while an expanding parameter works.
+    with pytest.raises(StatementError, match="A value is required for bind parameter 'n'"):
+        list(session(User)[User.name == bindparam('n')])
+    assert list(session(User)[User.id.in_(bindparam('ids', value=[1], expanding=True))]) == [jack]
+    # Result methods such as ``.q.all()`` and ``.q.count()`` behave the same way.
+    with pytest.raises(StatementError, match="A value is required for bind parameter 'n'"):
+        session(User)[User.name == bindparam('n')].q.all()
+    assert session(User)[User.id.in_(bindparam('ids', value=[1], expanding=True))].q.count() == 1
+
+    # A session's ``query_cls`` may override ``__iter__``, for example to filter every query. A baked query would bypass this, so it isn't used for these sessions.
+    class NoJackQuery(QueryMakerQuery):
+        def __iter__(self):
+            return QueryMakerQuery.__iter__(self.filter(User.name != 'jack'))
+    no_jack_session = sessionmaker(bind=engine, query_cls=NoJackQuery, class_=QueryMakerSession)()
+    assert list(no_jack_session(User)[User.fullname == 'Jack Bean']) == []
+    assert no_jack_session(User)[User.fullname == 'Jack Bean'].q.all() == []
+    assert compile_query(session(User)['x'], 'name')(no_jack_session, 'jack').all() == []
+    no_jack_session.close()
+
+    # A baked query selects the same way as ``to_query``, whether the query ends on a column or a class.
+    for query_maker in (session(User)['jack'].addresses.email_address, session(User)['jack'].addresses):
+        assert list(query_maker) == query_maker.to_query().all()
+
+    # Given a session, ``to_query`` produces a query of that session's ``query_cls``, whether or not the query joins.
+    assert type(User['jack'].to_query(session)) is QueryMakerQuery
+    assert type(User['jack'].addresses.to_query(session)) is QueryMakerQuery
+
+    # Different ``query_cls`` classes may define methods with the same name which return different types: here, ``recent`` returns a query for one class and a list for the other.
+    class RecentQuery(QueryMakerQuery):
+        def recent(self, n):
+            return self.limit(n)
+    class RecentListQuery(QueryMakerQuery):
+        def recent(self, n):
+            return self.limit(n).all()
+    recent_session = sessionmaker(bind=engine, query_cls=RecentQuery, class_=QueryMakerSession)()
+    recent_list_session = sessionmaker(bind=engine, query_cls=RecentListQuery, class_=QueryMakerSession)()
+    assert [user.name for user in recent_session(User).q.recent(1)] == ['jack']
+    assert [user.name for user in recent_list_session(User).q.recent(1)] == ['jack']
+    recent_session.close()
+    recent_list_session.close()
+
+    # A key whose type is a subclass of a type in ``default_query_map``, such as a subclass of ``str``, uses that type's entry.
+    class Name(str):
+        pass
+    print_query("session(User)[Name('jack')]", [jack], globals_, locals())
+
+    # Helpers such as ``compile_query`` aren't attributes of a QueryMaker, so they can't hide a column or relationship with the same name.
+    assert not any(hasattr(QueryMaker, name) for name in ('chain', 'compile', 'cache_clear'))
+
+    # Each alias is a new join point; looking up its attributes and keys doesn't add entries to the per-class caches.
+    size = _resolve_class_attribute.cache_info().currsize
+    for _ in range(3):
+        adalias = aliased(Address)
+        print_query("session(User).q.join(adalias, User.addresses)['j25@yahoo.com'].email_address", [('j25@yahoo.com', )], globals_, locals())
+    assert _resolve_class_attribute.cache_info().currsize == size
+
+    # Clearing the caches doesn't affect results.
+    cache_clear()
+    print_query("session(User)['jack'].addresses['jack@google.com']", [jack.addresses[0]], globals_)
 
 # main
 # ====
 # Run the example code. This can also be `tested using pytest <pytest syntax>`.
 if __name__ == '__main__':
     test_traditional_versus_pythonic()
-    test_more_examples()
+    for str_query, expected_result in MORE_EXAMPLES:
+        test_more_examples(str_query, expected_result)
+    test_query_examples()
     test_advanced_examples()
+    test_regressions()
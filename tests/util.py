@@ -9,34 +9,80 @@
 #
 # Standard library
 # ----------------
-# None.
+from contextlib import contextmanager
+from functools import lru_cache
+import os
 
 # Third-party imports
 # -------------------
-# None.
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
 # Local imports
 # -------------
-from pythonic_sqlalchemy_query import QueryMaker
+# None.
 
 # Code
 # ====
-# Print a query its underlying SQL.
-def _print_query(str_query, globals_, locals_=None):
+# Compile a query string into a code object once, so that repeated queries skip parsing and compiling. Like ``eval``, ignore leading whitespace in the query string.
+@lru_cache(maxsize=256)
+def _compile(str_query):
+    return compile(str_query.strip(), '<print_query>', 'eval')
+
+# Print a query its underlying SQL. ``str_query`` is usually a string containing the query, which is evaluated using ``globals_`` and ``locals_``. It may also be a pair of a query that was already built, such as a QueryMaker or Query, and the string which built it; this avoids evaluating and building a query used by several tests each time, while still printing the query's source.
+def _print_query(str_query, globals_=None, locals_=None):
+    if isinstance(str_query, str):
+        query = None
+    else:
+        query, str_query = str_query
     print('-'*78)
     print('Query: ' + str_query)
-    query = eval(str_query, globals_, locals_)
-    if isinstance(query, QueryMaker):
+    if query is None:
+        query = eval(_compile(str_query), globals_, locals_)
+    if getattr(query, '_is_query_maker', False):
         query = query.q
-    print('Resulting SQL emitted:\n{}\nResults:'.format(str(query)))
+    # Converting the query to a string compiles it a second time, in addition to compiling it for execution. Only do this when the environment variable ``PSQ_VERBOSE`` is set, for example by running ``PSQ_VERBOSE=1 pytest -s tests``.
+    if os.environ.get('PSQ_VERBOSE'):
+        print('Resulting SQL emitted:\n{}'.format(str(query)))
+    print('Results:')
     return query
 
 # Print the results of a query and optionally compare the results with the expected value.
-def print_query(str_query, expected_result=None, globals_=None, locals_=None):
+def print_query(str_query, expected_result=None, globals_=None, locals_=None,
+    # The maximum number of SQL statements which running the query may execute. This catches queries which load related objects one at a time (the N+1 problem).
+    max_queries=2):
+
     query = _print_query(str_query, globals_, locals_)
-    for _ in query:
+    # Run the query once, then both print and check these results, rather than running it again to check them.
+    with capture_sql() as statements:
+        rows = list(query)
+    assert len(statements) <= max_queries, statements
+    for _ in rows:
         print(_)
     print('')
     if expected_result:
-        assert query.all() == expected_result
+        assert rows == expected_result
     return query
+
+# Record the SQL statements sent to the database by ``engine`` (by default, by any engine) while in a ``with`` block, using the `before_cursor_execute <http://docs.sqlalchemy.org/en/latest/core/events.html#sqlalchemy.events.ConnectionEvents.before_cursor_execute>`_ event. For example, ``with capture_sql(engine) as statements:`` provides a list of the statements executed in the block.
+@contextmanager
+def capture_sql(engine=Engine):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+# The test databases are temporary, so there's no need to protect them against a crash. When ``engine`` connects to a SQLite database, keep its rollback journal in memory and don't wait for writes to reach the disk. (An in-memory database already keeps its journal in memory.)
+def fast_sqlite(engine):
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=MEMORY')
+        cursor.execute('PRAGMA synchronous=OFF')
+        cursor.close()